@@ -1,9 +1,34 @@
 import time
 import logging
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
 from argparse import ArgumentParser
 from pyaml_env import parse_config
+from requests import RequestException
 from guardicore.centra import CentraAPI
-from ldap3 import Server, Connection, SAFE_SYNC, ALL_ATTRIBUTES, SUBTREE
+from threading import Lock
+from ldap3 import Server, Connection, SAFE_SYNC, ALL_ATTRIBUTES, SUBTREE, BASE
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.dn import parse_dn
+
+# LDAP control that returns deleted objects (tombstones) in a search
+SHOW_DELETED_OID = '1.2.840.113556.1.4.417'
+
+# The computers found for each rule and domain, along with the USN
+# they are current to, so later passes only fetch what changed
+_COMPUTER_STATE = {}
+
+# Bound LDAP connections keyed by (server, bind user), reused across passes
+_LDAP_POOL = {}
+_LDAP_POOL_LOCK = Lock()
+
+# Seconds to wait for a domain controller to accept a connection
+LDAP_CONNECT_TIMEOUT = 10
+
+# Agents are looked up in batches with a multi-value gc_filter until a
+# batch shows the filter is not supported
+_BATCH_LOOKUPS = True
 
 
 def load_config(path: str = "config.yml") -> dict:
@@ -23,49 +48,462 @@ def load_config(path: str = "config.yml") -> dict:
     return config
 
 
-def get_computers(server_name: str, username: str, password: str, base_dn: str, target_dn: str) -> list:
+def chunks(seq, n: int):
+    """Splits an iterable in to successive chunks of n items
+    without consuming more of it than needed
+
+    Parameters:
+        seq (iterable): The iterable to split
+        n (int): The maximum number of items in each chunk
+
+    Returns:
+        generator: Yields lists of at most n items
     """
-    Loads computers from an LDAP group or Active Directory OU in to a list
-    that can be processed by another function.
+    iterator = iter(seq)
+    chunk = list(islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, n))
+
+
+def _first(value):
+    """Returns the first value of a multi-valued LDAP attribute, or the value
+    itself if it is already single valued"""
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def _dn_components(dn: str) -> tuple:
+    """Splits a distinguished name in to lowercased (type, value) pairs so
+    DNs can be compared regardless of case or spacing around separators"""
+    return tuple((t.lower(), v.lower()) for t, v, _ in parse_dn(dn, strip=True))
+
+
+def get_connection(server_name: str, username: str, password: str) -> Connection:
+    """
+    Returns a bound connection to an LDAP server, reusing the connection
+    opened by a previous call when it is still open
 
     Parameters:
         server_name (str): The server to bind to
-        base_dn (str): The base DN of the domain
         username (str): The DN of the user used to bind to ldap
         password (str): The password of the user to bind to ldap
+
+    Returns:
+        Connection: A bound LDAP connection
+    """
+
+    with _LDAP_POOL_LOCK:
+        connection = _LDAP_POOL.get((server_name, username))
+    if connection and not connection.closed:
+        return connection
+
+    # Bind outside the lock so a slow or unreachable domain controller
+    # does not hold up connections to the other domains.  If the secure
+    # ports are defined on the server name establish the connection over TLS/SSL
+    if any([server_name.endswith('636'),server_name.endswith('3269')]):
+        server = Server(server_name.split(':')[0], use_ssl=True, connect_timeout=LDAP_CONNECT_TIMEOUT)
+    else:
+        server = Server(server_name, connect_timeout=LDAP_CONNECT_TIMEOUT)
+
+    connection = Connection(server, username, password, client_strategy=SAFE_SYNC, auto_bind=True, auto_referrals=False)
+
+    with _LDAP_POOL_LOCK:
+        pooled = _LDAP_POOL.get((server_name, username))
+
+        # Another thread may have connected while this one was binding
+        if pooled and not pooled.closed:
+            duplicate, connection = connection, pooled
+        else:
+            duplicate = None
+            _LDAP_POOL[(server_name, username)] = connection
+
+    if duplicate:
+        duplicate.unbind()
+
+    return connection
+
+
+def drop_connection(server_name: str, username: str, connection: Connection) -> None:
+    """
+    Closes and forgets a pooled LDAP connection so the next call
+    to get_connection opens a new one.  Nothing is done if the pool
+    has already replaced the connection
+
+    Parameters:
+        server_name (str): The server the connection is bound to
+        username (str): The DN of the user the connection is bound as
+        connection (Connection): The connection that failed
+    """
+
+    with _LDAP_POOL_LOCK:
+        if _LDAP_POOL.get((server_name, username)) is not connection:
+            return
+        del _LDAP_POOL[(server_name, username)]
+
+    try:
+        connection.unbind()
+    except LDAPException:
+        pass
+
+
+def get_highest_usn(connection: Connection) -> tuple:
+    """
+    Reads the highest committed USN from the RootDSE of the domain
+    controller the connection is bound to.  USNs are local to each
+    domain controller so the DSA name is returned alongside it
+
+    Parameters:
+        connection (Connection): A bound LDAP connection
+
+    Returns:
+        tuple: The DSA service name and its highest committed USN
+    """
+
+    _, _, response, _ = connection.search(
+        '', '(objectClass=*)', search_scope=BASE, attributes=['dsServiceName', 'highestCommittedUSN']
+    )
+
+    attributes = response[0]['attributes']
+    return _first(attributes['dsServiceName']), int(_first(attributes['highestCommittedUSN']))
+
+
+def get_computers(connection: Connection, base_dn: str, target_dn: str) -> Iterable[tuple]:
+    """
+    Loads computers from an LDAP group or Active Directory OU as they are
+    paged back from the server so they can be processed by another function.
+
+    Parameters:
+        connection (Connection): A bound LDAP connection
+        base_dn (str): The base DN of the domain
         target_dn (str): The distinguished name of the target OU or Group
     
     Returns:
-        list: The list of computers in the OU or AD group
+        Iterable[tuple]: The objectGUID and name of each computer in the OU or AD group
     """
 
     search_filter = "(objectclass=computer)" # The default search filter
-    result = [] # Empty result set
 
     # If looking for group members
     if target_dn.startswith('CN'):
         search_filter = f"(&(objectClass=computer)(memberof={target_dn}))"
     else:
         base_dn = target_dn
-    
-    # If the secure ports are defined on the server name
-    # establish the connection over TLS/SSL
-    if any([server_name.endswith('636'),server_name.endswith('3269')]):
-        server = Server(server_name.split(':')[0], use_ssl=True)
-    else:
-        server = Server(server_name)
-
-    connection = Connection(server, username, password, client_strategy=SAFE_SYNC, auto_bind=True, auto_referrals=False)
 
-    # Gets all the computer objects in a specified OU and returns
-    # a list of computer names
+    # Gets all the computer objects in a specified OU and yields
+    # the computer names
     generator = connection.extend.standard.paged_search(
-        base_dn, search_filter, attributes=['name'], paged_size=250, generator=True
+        base_dn, search_filter, attributes=['name', 'objectGUID'], paged_size=250, generator=True
     )
 
     # Only return results that have attributes
-    result = [computer['attributes']['name'] for computer in generator if 'attributes' in computer]
-    return result
+    for computer in generator:
+        if 'attributes' in computer:
+            yield computer['attributes']['objectGUID'], computer['attributes']['name']
+
+
+def get_computer_changes(connection: Connection, base_dn: str, target_dn: str, usn: int) -> dict:
+    """
+    Loads the computers that have changed since a USN and works out
+    whether they are still members of the LDAP group or Active Directory OU
+
+    Parameters:
+        connection (Connection): A bound LDAP connection
+        base_dn (str): The base DN of the domain
+        target_dn (str): The distinguished name of the target OU or Group
+        usn (int): The highest USN seen by the previous search
+
+    Returns:
+        dict: Computer names keyed by objectGUID, None for computers that are
+              no longer members.  Returns None if a full search is required
+    """
+
+    changes = {}
+    is_group = target_dn.startswith('CN')
+    target = _dn_components(target_dn)
+
+    # Group membership changes are written to the group, not the computer,
+    # so a changed group needs a full search
+    if is_group:
+        _, _, response, _ = connection.search(
+            target_dn, '(objectClass=group)', search_scope=BASE, attributes=['uSNChanged']
+        )
+        if not response or int(_first(response[0]['attributes']['uSNChanged'])) > usn:
+            return None
+
+    # Search the whole domain so computers moved out of the OU are seen
+    generator = connection.extend.standard.paged_search(
+        base_dn, f"(&(objectClass=computer)(uSNChanged>={usn+1}))",
+        attributes=['name', 'objectGUID', 'distinguishedName', 'memberOf'], paged_size=250, generator=True
+    )
+
+    for computer in generator:
+        if 'attributes' not in computer:
+            continue
+
+        attributes = computer['attributes']
+        if is_group:
+            member = target in [_dn_components(g) for g in attributes.get('memberOf', [])]
+        else:
+            dn = _dn_components(attributes['distinguishedName'])
+            member = len(dn) > len(target) and dn[-len(target):] == target
+
+        changes[attributes['objectGUID']] = attributes['name'] if member else None
+
+    # Deleted computers are only returned when asking for tombstones
+    generator = connection.extend.standard.paged_search(
+        base_dn, f"(&(objectClass=computer)(isDeleted=TRUE)(uSNChanged>={usn+1}))",
+        attributes=['objectGUID'], controls=[(SHOW_DELETED_OID, True, None)], paged_size=250, generator=True
+    )
+
+    for computer in generator:
+        if 'attributes' in computer:
+            changes[computer['attributes']['objectGUID']] = None
+
+    return changes
+
+
+def sync_computers(rule: str, domain: str, domain_config: dict, target_dn: str) -> Iterable[str]:
+    """
+    Yields the computers for a rule in a domain.  The first call streams every
+    computer from LDAP, later calls only apply the changes made since the
+    previous call.  The stored state is only updated once every computer
+    has been consumed
+
+    Parameters:
+        rule (str): The name of the rule
+        domain (str): The name of the domain
+        domain_config (dict): The configuration for the domain
+        target_dn (str): The distinguished name of the target OU or Group
+
+    Returns:
+        Iterable[str]: The names of the computers in the OU or AD group
+    """
+
+    server_name = domain_config['server']
+    username = domain_config['bind_user']
+
+    connection = get_connection(server_name, username, domain_config['bind_password'])
+
+    # Read the USN before searching so changes made during the
+    # search are picked up by the next one.  A pooled connection may
+    # have been closed by the server since it was last used, so
+    # reconnect once if the first request fails
+    try:
+        server, usn = get_highest_usn(connection)
+    except LDAPException:
+        drop_connection(server_name, username, connection)
+        connection = get_connection(server_name, username, domain_config['bind_password'])
+        try:
+            server, usn = get_highest_usn(connection)
+        except LDAPException:
+            drop_connection(server_name, username, connection)
+            raise
+
+    try:
+        state = _COMPUTER_STATE.get((rule, domain))
+        changes = None
+
+        if state and state['server'] == server:
+            changes = get_computer_changes(connection, domain_config['base_dn'], target_dn, state['usn'])
+
+        if changes is None:
+            computers = {}
+            for guid, name in get_computers(connection, domain_config['base_dn'], target_dn):
+                computers[guid] = name
+                yield name
+        else:
+            computers = state['computers']
+            for guid, name in changes.items():
+                if name is None:
+                    computers.pop(guid, None)
+                else:
+                    computers[guid] = name
+            yield from computers.values()
+    except LDAPException:
+        drop_connection(server_name, username, connection)
+        raise
+
+    _COMPUTER_STATE[(rule, domain)] = {'server': server, 'usn': usn, 'computers': computers}
+
+
+def _list_agents(centra: CentraAPI, gc_filter: str, limit: int) -> list:
+    """
+    Lists the agents matching a filter, raising an error if Guardicore
+    could not be queried so a failed lookup is never mistaken for a
+    computer without an agent
+    """
+
+    agents = centra.list_agents(gc_filter=gc_filter, limit=limit)
+    if agents is None:
+        raise RuntimeError(f"Failed to look up agents matching {gc_filter}")
+    return agents
+
+
+def get_agent_ids(centra: CentraAPI, computers: list) -> list:
+    """
+    Looks up the Guardicore asset ids for a batch of computers using
+    a single multi-value filter.  If the batch matches no agents each
+    computer is looked up on its own in case the multi-value filter is
+    not supported, and batching is turned off if that finds agents
+
+    Parameters:
+        centra (CentraAPI): An authenticated Centra API object
+        computers (list): The names of the computers to look up
+
+    Returns:
+        list: The asset ids of the computers that have an agent
+    """
+
+    global _BATCH_LOOKUPS
+
+    def match(agents):
+        # Agent names may be fully qualified, AD computer names are not
+        by_name = {a['name'].split('.')[0].lower(): a['asset_id'] for a in agents if a.get('name')}
+        return [by_name[c.lower()] for c in computers if c.lower() in by_name]
+
+    # Fetch the whole batch as a single page
+    if _BATCH_LOOKUPS or len(computers) == 1:
+        agent_ids = match(_list_agents(centra, "|".join(computers), len(computers)))
+        if agent_ids or len(computers) == 1:
+            return agent_ids
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = executor.map(lambda computer: _list_agents(centra, computer, 20), computers)
+        agent_ids = match([agent for result in results for agent in result])
+
+    if agent_ids and _BATCH_LOOKUPS:
+        logging.warning("Multi-value gc_filter lookups found no agents, looking up computers individually")
+        _BATCH_LOOKUPS = False
+
+    return agent_ids
+
+
+def process_rule(rule: str, rule_config: dict, domains: dict, labels: dict, centra: CentraAPI) -> list:
+    """
+    Works out the label changes needed for a single rule by comparing the
+    computers found in LDAP with the assets currently in each label
+
+    Parameters:
+        rule (str): The name of the rule
+        rule_config (dict): The configuration for the rule
+        domains (dict): The configuration for every domain
+        labels (dict): The current labels keyed by (key, value)
+        centra (CentraAPI): An authenticated Centra API object
+
+    Returns:
+        list: Tuples of (action, key, value, asset ids) to pass to apply_label_changes
+    """
+
+    # Label changes are collected and sent together once every rule is done
+    writes = []
+
+    # A failing domain controller or Guardicore lookup skips this rule
+    # for the pass rather than stopping the other rules
+    try:
+        # Look up agents in batches using a multi-value filter instead
+        # of issuing one API call per computer, running the batches
+        # concurrently to overlap the API latency
+        with ThreadPoolExecutor(max_workers=16) as lookups:
+
+            def fetch_domain(domain):
+                logging.info(f'Fetching computers for {rule} from {domain}')
+
+                target_dn = rule_config['domains'][domain]['target_dn']
+
+                # Computers are streamed from LDAP so agent lookups start
+                # while later pages are still being fetched
+                computers = sync_computers(rule, domain, domains[domain], target_dn)
+                return [lookups.submit(get_agent_ids, centra, chunk) for chunk in chunks(computers, 100)]
+
+            # Each domain is fetched from its own domain controller so
+            # the LDAP searches run side by side
+            with ThreadPoolExecutor(max_workers=max(1, len(rule_config['domains']))) as searches:
+                futures = [f for domain_futures in searches.map(fetch_domain, rule_config['domains']) for f in domain_futures]
+
+            guardicore_agent_ids = [agent_id for f in futures for agent_id in f.result()]
+    except Exception as exc:
+        logging.error(f"Skipping {rule} for this pass: {exc!r}")
+        return writes
+
+    # Computers were found but none matched an agent, this is more likely
+    # a lookup problem than every agent disappearing so keep the labels
+    missing_agents = len(futures) > 0 and len(guardicore_agent_ids) == 0
+
+    for key in rule_config['labels']:
+
+        value = rule_config['labels'][key]
+
+        label_data = labels.get((key, str(value)))
+        if label_data:
+            added = {b['id'] for b in label_data.get('added_assets', [])}
+            current = set(guardicore_agent_ids)
+
+            new_agents = list(current - added)
+
+            # Determine what agents are no longer valid
+            old_agents = list(added - current)
+
+            if len(old_agents) > 0 and missing_agents:
+                logging.warning(f"No agents found for {rule}, not removing {len(old_agents)} from label {key}: {value}")
+            elif len(old_agents) > 0:
+                writes.append(('remove', key, value, old_agents))
+
+            if len(new_agents) > 0:
+                writes.append(('add', key, value, new_agents))
+
+            if len(old_agents) == 0 and len(new_agents) == 0:
+                logging.info(f"No changes for {key}: {value}")
+        elif len(guardicore_agent_ids) > 0:
+            writes.append(('add', key, value, guardicore_agent_ids))
+
+    return writes
+
+
+def apply_label_changes(centra: CentraAPI, writes: list, chunk_size: int = 1000) -> None:
+    """
+    Sends a batch of label changes to Guardicore concurrently, splitting
+    large asset lists in to multiple requests
+
+    Parameters:
+        centra (CentraAPI): An authenticated Centra API object
+        writes (list): Tuples of (action, key, value, asset ids) where action
+                       is either add or remove
+        chunk_size (int): The maximum number of asset ids sent per request
+    """
+
+    actions = {
+        'add': centra.create_static_label,
+        'remove': centra.remove_asset_from_label
+    }
+
+    calls = [
+        (i, actions[action], key, value, chunk)
+        for i, (action, key, value, vms) in enumerate(writes)
+        for chunk in chunks(vms, chunk_size)
+    ]
+
+    def call(request):
+        i, action, key, value, chunk = request
+        try:
+            return i, action(key, value, chunk)
+        except RequestException as exc:
+            logging.error(exc)
+            return i, False
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(call, calls))
+
+    failed = {i for i, success in results if not success}
+
+    for i, (action, key, value, vms) in enumerate(writes):
+        if i in failed:
+            logging.error(f"Failed to {action} {len(vms)} assets for label {key}: {value}")
+        elif action == 'add':
+            logging.info(f"Labeled {len(vms)} with label {key}: {value}")
+        else:
+            logging.info(f"Removed {len(vms)} from label {key}: {value}")
 
 
 if __name__ == "__main__":
@@ -92,7 +530,10 @@ if __name__ == "__main__":
         config['guardicore']['management_url'] = args.gc_management_url
 
     logging.info("Authenticating to Guardicore")
-    centra = CentraAPI(management_url=config['guardicore']['management_url'])
+    centra = CentraAPI(
+        management_url=config['guardicore']['management_url'],
+        max_connections=config['guardicore'].get('max_connections', 32)
+    )
 
     try:
         centra.authenticate(
@@ -101,62 +542,53 @@ if __name__ == "__main__":
         logging.error(exc)
         exit(1)
 
-    while True:
-        for rule in config['rules']:
-            rule_config = config['rules'][rule]
-
-            computers = []
-
-            for domain in rule_config['domains']:
-           
-                domain_config = config['domains'][domain]
-
-                logging.info(f'Fetching computers for {rule} from {domain}')
-
-                target_dn = rule_config['domains'][domain]['target_dn']
-
-                computers += get_computers(
-                    server_name=domain_config['server'],
-                    base_dn=domain_config['base_dn'],
-                    username=domain_config['bind_user'],
-                    password=domain_config['bind_password'],
-                    target_dn=target_dn
-                )
-
-            guardicore_agent_ids = []
-
-            for computer in computers:
-                agent_info = centra.list_agents(gc_filter=computer)
-                if len(agent_info) > 0:
-                    guardicore_agent_ids.append(agent_info[0]['asset_id'])
-
-            number_of_agents = len(guardicore_agent_ids)
-
-            for key in rule_config['labels']:
-
-                changed=False
-                value = rule_config['labels'][key]
+    # Back off polling while passes produce no label changes
+    poll_interval = config['poll_interval']
+    max_idle_interval = config.get('max_idle_interval', poll_interval*8)
+    interval = poll_interval
 
-                label_data = centra.list_labels(key=key, value=value, find_matches=True)
-                if len(label_data) > 0:
-                    new_agents = [a for a in guardicore_agent_ids if a not in [b['id'] for b in label_data[0]['added_assets']]]
+    # The label keys used by any rule, the label snapshot is limited to these
+    label_keys = sorted({key for rule in config['rules'].values() for key in rule['labels']})
 
-                    # Determine what agents are no longer valid
-                    old_agents = [b['id'] for b in label_data[0]['added_assets'] if b['id'] not in guardicore_agent_ids]
-
-                    if len(old_agents) > 0:
-                        if centra.remove_asset_from_label(key, value, old_agents):
-                            logging.info(f"Removed {len(old_agents)} from label {key}: {value}")
-                    
-                    if len(new_agents) > 0:
-                        centra.create_static_label(key, value, new_agents)
-                        logging.info(f"Labeled {len(new_agents)} with label {key}: {value}")
-                        changed=True
-
-                    if not changed:
-                        logging.info(f"No changes for {key}: {value}")
-                else:
-                    logging.info(f"Labeled {number_of_agents} with {key}: {value}")
-                    centra.create_static_label(key, value, guardicore_agent_ids)
-
-        time.sleep(config['poll_interval'])
+    while True:
+        # Intervals are measured from the start of each pass so the
+        # time spent reconciling does not push the next pass back
+        start = time.monotonic()
+
+        # Take one snapshot of the labels used by the rules instead of
+        # looking each label up separately, label writes are only sent
+        # after every rule is processed so the snapshot stays current
+        try:
+            snapshots = [centra.list_all_labels(key=key, find_matches=True) for key in label_keys]
+        except RequestException as exc:
+            logging.error(exc)
+            snapshots = [None]
+
+        if any(snapshot is None for snapshot in snapshots):
+            logging.error("Failed to fetch labels from Guardicore")
+            time.sleep(max(0, poll_interval - (time.monotonic() - start)))
+            continue
+
+        labels = {(l['key'], str(l['value'])): l for snapshot in snapshots for l in snapshot}
+
+        # Rules are independent so they are reconciled concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(config['rules'])))) as executor:
+            results = executor.map(
+                lambda rule: process_rule(rule, config['rules'][rule], config['domains'], labels, centra), config['rules']
+            )
+            writes = [write for rule_writes in results for write in rule_writes]
+
+        # Double the interval after each idle pass, capped so it stops growing
+        if writes:
+            apply_label_changes(centra, writes)
+            interval = poll_interval
+        else:
+            interval = min(interval * 2, max_idle_interval)
+
+        elapsed = time.monotonic() - start
+
+        # Start the next pass straight away if this one overran
+        if elapsed >= interval:
+            logging.warning(f"Pass took {elapsed:.0f}s, longer than the {interval}s interval")
+        else:
+            time.sleep(interval - elapsed)
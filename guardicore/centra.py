@@ -1,13 +1,25 @@
 import json
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 
+# orjson decodes large responses considerably faster but is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class CentraAPI(object):
 
-    def __init__(self, management_url="", http_scheme="https"):
+    def __init__(self, management_url="", http_scheme="https", max_connections=32):
         """
         Initializes an API object that is used
-        to make consistent calls to the Guardicore Centra API
+        to make consistent calls to the Guardicore Centra API.
+        At most max_connections connections are opened to Centra
         """
 
         self.management_url = management_url
@@ -15,10 +27,32 @@ class CentraAPI(object):
         self.http_scheme = http_scheme
         self.base_url = f"{self.http_scheme}://{self.management_url}"
 
+        # Size the connection pool so concurrent API calls reuse
+        # connections instead of opening new ones, and retry transient
+        # gateway errors.  Once retries run out the last response is returned
+        # so the status code checks below handle it.  Rules, agent lookups
+        # and pagination all run in thread pools, so requests beyond the pool
+        # size wait for a pooled keep-alive connection rather than opening a
+        # throwaway one
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retries, pool_block=True
+        )
+        self.session.mount("https://", adapter)
+
+        # Ask for compressed responses explicitly, the large label and
+        # asset listings compress well
         self.session.headers.update({
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive',
+            'Accept-Encoding': 'gzip, deflate'
         })
 
+        # Label responses keyed by (key, value, url) along with their ETag
+        # so unchanged labels are not downloaded again
+        self._label_cache = {}
+        self._label_cache_lock = threading.Lock()
+
     def _format_parameters(self, parameters: dict) -> str:
         '''Formats a supplied dictionary of parameters as a URL query string
         
@@ -31,12 +65,147 @@ class CentraAPI(object):
 
         if isinstance(parameters, dict):
 
-            # Format booleans as lowercase true/false
-            for k in parameters:
-                if isinstance(parameters[k], bool):
-                    parameters[k] = str(parameters[k]).lower()
+            # Format booleans as lowercase true/false without
+            # modifying the supplied dictionary
+            return urlencode({
+                k: (str(v).lower() if isinstance(v, bool) else v) for k, v in parameters.items()
+            })
+
+    def _json(self, response: requests.Response):
+        '''Decodes the JSON body of a response, using orjson when it is installed
+
+        Parameters:
+            response (requests.Response): The response to decode
+
+        Returns:
+            The decoded JSON body
+        '''
+
+        if orjson:
+            return orjson.loads(response.content)
+        return response.json()
+
+    def _dumps(self, data) -> bytes:
+        '''Encodes a request body as compact JSON, using orjson when it is installed
+
+        Parameters:
+            data: The object to encode
+
+        Returns:
+            bytes: The encoded JSON body
+        '''
+
+        if orjson:
+            return orjson.dumps(data)
+        return json.dumps(data, separators=(',', ':')).encode()
+
+    def _invalidate_label_cache(self, key: str, value: str) -> None:
+        '''Drops any cached responses for a label after it has been changed
+
+        Parameters:
+            key (str): The label key
+            value (str): The label value
+        '''
+
+        # Responses that were not filtered by key or value may contain the label too
+        with self._label_cache_lock:
+            for cache_key in [k for k in self._label_cache if k[0] in (key, None) and k[1] in (value, None)]:
+                del self._label_cache[cache_key]
+
+    def _get_label_response(self, url: str, key: str = None, value: str = None):
+        '''Fetches a label API response, revalidating a previously cached
+        copy with its ETag instead of downloading it again
+
+        Parameters:
+            url (str): The full URL to fetch
+            key (str): The label key the request is filtered by
+            value (str): The label value the request is filtered by
+
+        Returns:
+            The decoded JSON body, None if the request fails
+        '''
+
+        cache_key = (key, value, url)
+        with self._label_cache_lock:
+            cached = self._label_cache.get(cache_key)
+
+        headers = {'If-None-Match': cached[0]} if cached else {}
+
+        response = self.session.get(url, headers=headers)
+        if response.status_code == 304 and cached:
+            return cached[1]
+        elif response.status_code == 200:
+            data = self._json(response)
+
+            if 'ETag' in response.headers:
+                with self._label_cache_lock:
+                    self._label_cache[cache_key] = (response.headers['ETag'], data)
+
+            return data
+        else:
+            print(response.status_code)
+            print(response.text)
+            return None
+
+    def _get_paged(self, api_endpoint: str, parameters: dict = None, limit: int = 20, page: int = 0, label: tuple = None) -> list:
+        '''Fetches every page of a paginated API endpoint starting from the
+        supplied page
+
+        Parameters:
+            api_endpoint (str): The API endpoint
+            parameters (dict): Additional URL query parameters
+            limit (int): How many objects to fetch per page
+            page (int): The page to start from
+            label (tuple): The (key, value) a label listing is filtered by, pages
+                           of label listings are revalidated with their ETag
+
+        Returns:
+            list: The combined objects from every page, None if a request fails
+        '''
+
+        # A zero or negative page size would never advance the offset
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+
+        parameters = parameters or {}
+        offset = limit * page
+
+        def get_page(offset):
+            query = self._format_parameters({**parameters, 'limit': limit, 'offset': offset})
+            if label:
+                return self._get_label_response(f"{self.base_url}{api_endpoint}?{query}", *label)
+
+            response = self.session.get(f"{self.base_url}{api_endpoint}?{query}")
+            if response.status_code != 200:
+                return None
+            return self._json(response)
+
+        response_data = get_page(offset)
+        if response_data is None:
+            return None
+
+        # Create the result set from the first page
+        results = list(response_data['objects'])
+
+        # Work out which pages remain now that the total is known, this is
+        # empty when the total fits within the first page (including 0)
+        offsets = range(offset + limit, response_data.get('total_count', 0), limit)
+        n_pages = len(offsets) + 1
+
+        # Fetch the remaining pages concurrently when there are enough of them,
+        # executor.map preserves page order
+        if n_pages > 2:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                pages = list(executor.map(get_page, offsets))
+        else:
+            pages = [get_page(o) for o in offsets]
 
-            return '&'.join([f'{k}={parameters[k]}' for k in parameters])
+        for page_data in pages:
+            if page_data is None:
+                return None
+            results.extend(page_data['objects'])
+
+        return results
 
     def authenticate(self, username, password):
         """
@@ -49,9 +218,9 @@ class CentraAPI(object):
             "password": password
         }
 
-        response = self.session.post(f"{self.base_url}/api/v3.0/authenticate", data=json.dumps(auth_body))
+        response = self.session.post(f"{self.base_url}/api/v3.0/authenticate", json=auth_body)
         if response.status_code == 200:
-            data = response.json()
+            data = self._json(response)
 
             # If the account in use has MFA enabled, raise a ValueError
             if '2fa_temp_token' in data:
@@ -80,7 +249,7 @@ class CentraAPI(object):
                 "ruleset_name": rule_set + " | Outbound",
                 "value": ip
             }
-            self.session.post(f"{self.base_url}/api/v3.0/widgets/malicious-reputation-block", data=json.dumps(data))
+            self.session.post(f"{self.base_url}/api/v3.0/widgets/malicious-reputation-block", json=data)
             
         if direction in ["SOURCE", "BOTH"]:
             data = {
@@ -89,7 +258,7 @@ class CentraAPI(object):
                 "ruleset_name": rule_set + " | Inbound",
                 "value": ip
             }
-            self.session.post(f"{self.base_url}/api/v3.0/widgets/malicious-reputation-block", data=json.dumps(data))
+            self.session.post(f"{self.base_url}/api/v3.0/widgets/malicious-reputation-block", json=data)
 
 
     def get_incidents(self, tags=[], tag__not=["Acknowledged"], limit=500, from_hours=24):
@@ -106,7 +275,7 @@ class CentraAPI(object):
         url = f"{self.base_url}/api/v3.0/incidents?tag={tag_list}&tag__not={tag__not}&from_time={from_time}&to_time={to_time}&limit={limit}"
         response = self.session.get(url)
         if response.status_code == 200:
-            data = response.json()
+            data = self._json(response)
             return data['objects']
         else:
             return []
@@ -127,7 +296,7 @@ class CentraAPI(object):
                 "negate_args": None,
                 "ids": [id]
             }
-            self.session.post(f"{self.base_url}/api/v3.0/incidents/tag", data=json.dumps(data))
+            self.session.post(f"{self.base_url}/api/v3.0/incidents/tag", json=data)
 
     def acknowledge_incident(self, ids=[]):
         """
@@ -143,7 +312,7 @@ class CentraAPI(object):
             "ids": ids,
             "negate_args": None
         }
-        self.session.post(f"{self.base_url}/api/v3.0/incidents/acknowledge", data=json.dumps(data))
+        self.session.post(f"{self.base_url}/api/v3.0/incidents/acknowledge", json=data)
 
     def get_inner(self, destination, source):
         """
@@ -173,9 +342,9 @@ class CentraAPI(object):
             "query": query
         }
 
-        response = self.session.post(f"{self.base_url}{api_endpoint}", data=json.dumps(data))
+        response = self.session.post(f"{self.base_url}{api_endpoint}", json=data)
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = self._json(response)
             return response_data['id']
         else:
             return None
@@ -192,7 +361,7 @@ class CentraAPI(object):
 
         response = self.session.get(f"{self.base_url}{api_endpoint}")
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = self._json(response)
 
             if status_only:
                 return response_data['status']
@@ -207,26 +376,9 @@ class CentraAPI(object):
         Fetches the result of a completed Insight query
         """
 
-        # Set the default value for to if not overridden
-        offset = limit * page
-
-        # Create an empty result set
-        results = []
+        api_endpoint = f"/api/v3.0/agents/query/{query_id}/results"
 
-        api_endpoint = f"/api/v3.0/agents/query/{query_id}/results?limit={limit}&offset={offset}"
-
-        response = self.session.get(f"{self.base_url}{api_endpoint}")
-        if response.status_code == 200:
-            response_data = response.json()
-            results += response_data['objects']
-
-            # Page if necessary
-            if page <= round(response_data['total_count']/limit)+1:
-                results += self.insight_query_results(query_id, page=response_data['current_page'])
-
-            return results
-        else:
-            return None
+        return self._get_paged(api_endpoint, limit=limit, page=page)
 
     def insight_label_agents(self, query_id, label_key, label_value, action=""):
         """
@@ -245,9 +397,9 @@ class CentraAPI(object):
             "label_value": label_value
         }
 
-        response = self.session.post(f"{self.base_url}{api_endpoint}", data=json.dumps(label_data))
+        response = self.session.post(f"{self.base_url}{api_endpoint}", json=label_data)
         if response.status_code == 200:
-            response_data = response.json()
+            response_data = self._json(response)
             return response_data
         else:
             return None
@@ -257,53 +409,22 @@ class CentraAPI(object):
         Returns a list of agents based on the criteria
         """
 
-        offset = limit * page
-        
-        api_endpoint = f"/api/v3.0/agents?limit={limit}&offset={offset}"
+        api_endpoint = "/api/v3.0/agents"
 
+        parameters = {}
         if 'gc_filter' in kwargs:
-            api_endpoint += f"&gc_filter={kwargs['gc_filter']}"
-
-        # Create an empty set of results
-        results = []
-
-        response = self.session.get(f"{self.base_url}{api_endpoint}")
-        if response.status_code == 200:
-            response_data = response.json()
-            results += response_data['objects']
+            parameters['gc_filter'] = kwargs['gc_filter']
 
-            # Page if necessary
-            if page <= round(response_data['total_count']/limit)+1:
-                results += self.list_agents(page=response_data['current_page'], limit=limit, *args, **kwargs, )
-
-            return results
-        else:
-            return None
+        return self._get_paged(api_endpoint, parameters, limit=limit, page=page)
 
     def list_assets(self, page=0, limit=20, *args, **kwargs):
         """
         Returns a list of assets based on the criteria
         """
 
-        offset = limit * page
-        
-        api_endpoint = f"/api/v3.0/assets?limit={limit}&offset={offset}"
-
-        # Create an empty set of results
-        results = []
+        api_endpoint = "/api/v3.0/assets"
 
-        response = self.session.get(f"{self.base_url}{api_endpoint}")
-        if response.status_code == 200:
-            response_data = response.json()
-            results += response_data['objects']
-
-            # Page if necessary
-            if page <= round(response_data['total_count']/limit)+1:
-                results += self.list_assets(page=response_data['current_page'], limit=limit, *args, **kwargs, )
-
-            return results
-        else:
-            return None
+        return self._get_paged(api_endpoint, limit=limit, page=page)
 
     def create_static_label(self, key, value, vms):
         """
@@ -316,7 +437,8 @@ class CentraAPI(object):
             "vms": vms
         }
 
-        response = self.session.post(f"{self.base_url}{api_endpoint}", data=json.dumps(data))
+        response = self.session.post(f"{self.base_url}{api_endpoint}", data=self._dumps(data))
+        self._invalidate_label_cache(key, value)
         if response.status_code == 200:
             return True
         else:
@@ -345,7 +467,8 @@ class CentraAPI(object):
         api_endpoint = f"/api/v3.0/assets/labels/{key}/{value}"
 
         response = self.session.post(
-            f"{self.base_url}{api_endpoint}", data=json.dumps(data))
+            f"{self.base_url}{api_endpoint}", data=self._dumps(data))
+        self._invalidate_label_cache(key, value)
         if response.status_code == 200:
             return True
         else:
@@ -387,15 +510,32 @@ class CentraAPI(object):
         if query:
             api_endpoint += f'?{query}'
 
-        response = self.session.get(f"{self.base_url}{api_endpoint}")
-        if response.status_code == 200:
-            return response.json()['objects']
-        else:
-            print(response.status_code)
-            print(response.text)
+        data = self._get_label_response(f"{self.base_url}{api_endpoint}", key, value)
+        if data is None:
             return None
-        
-        
-        
 
-        
+        return data['objects']
+
+    def list_all_labels(self, key: str = None, find_matches=False, limit: int = 500) -> list:
+        '''Fetches every label, optionally only those with a key, paging
+        through the results so many labels can be checked with a single
+        snapshot.  Unchanged pages are revalidated rather than downloaded again
+
+        Parameters:
+            key: Only return labels with this key
+            find_matches: Return assets that match each label in the response
+            limit: How many labels to fetch per page
+
+        Returns:
+            list: Every matching label, None if a request fails
+        '''
+
+        api_endpoint = "/api/v3.0/visibility/labels"
+
+        parameters = {}
+        if key:
+            parameters['key'] = key
+        if find_matches:
+            parameters['find_matches'] = find_matches
+
+        return self._get_paged(api_endpoint, parameters, limit=limit, label=(key, None))
@@ -0,0 +1,163 @@
+import io
+import gzip
+import json
+import unittest
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+from guardicore.centra import CentraAPI
+
+
+class FakeResponse(object):
+
+    def __init__(self, data, status_code=200, headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+    def json(self):
+        return self.data
+
+    @property
+    def content(self):
+        return json.dumps(self.data).encode()
+
+
+class FakeSession(object):
+    '''Serves a fixed list of objects through limit/offset pagination
+    and records the offsets that were requested'''
+
+    def __init__(self, total_count):
+        self.objects = list(range(total_count))
+        self.offsets = []
+
+    def get(self, url, **kwargs):
+        query = parse_qs(urlparse(url).query)
+        limit = int(query['limit'][0])
+        offset = int(query['offset'][0])
+        self.offsets.append(offset)
+
+        return FakeResponse({
+            'objects': self.objects[offset:offset+limit],
+            'total_count': len(self.objects)
+        })
+
+
+class TestGetPaged(unittest.TestCase):
+
+    def paged(self, total_count, limit=20, page=0):
+        centra = CentraAPI(management_url="centra.example.com")
+        centra.session = FakeSession(total_count)
+        return centra._get_paged("/api/v3.0/agents", limit=limit, page=page), centra.session.offsets
+
+    def test_no_results(self):
+        results, offsets = self.paged(0)
+        self.assertEqual(results, [])
+        self.assertEqual(offsets, [0])
+
+    def test_total_equal_to_limit(self):
+        results, offsets = self.paged(20)
+        self.assertEqual(results, list(range(20)))
+        self.assertEqual(offsets, [0])
+
+    def test_total_below_limit(self):
+        results, offsets = self.paged(5)
+        self.assertEqual(results, list(range(5)))
+        self.assertEqual(offsets, [0])
+
+    def test_total_far_above_limit(self):
+        results, offsets = self.paged(1005)
+        self.assertEqual(results, list(range(1005)))
+        self.assertEqual(sorted(offsets), list(range(0, 1005, 20)))
+
+    def test_start_page(self):
+        results, offsets = self.paged(100, page=2)
+        self.assertEqual(results, list(range(40, 100)))
+        self.assertEqual(sorted(offsets), [40, 60, 80])
+
+    def test_failed_page(self):
+        centra = CentraAPI(management_url="centra.example.com")
+        centra.session = FakeSession(100)
+        centra.session.get = lambda url, **kwargs: FakeResponse({}, status_code=500)
+        self.assertIsNone(centra._get_paged("/api/v3.0/agents"))
+
+    def test_invalid_limit(self):
+        with self.assertRaises(ValueError):
+            self.paged(10, limit=0)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_accept_encoding(self):
+        centra = CentraAPI(management_url="centra.example.com")
+        self.assertEqual(centra.session.headers['Accept-Encoding'], 'gzip, deflate')
+
+    def test_gzip_body_decodes(self):
+        data = {'objects': [{'id': i} for i in range(100)], 'total_count': 100}
+        body = gzip.compress(json.dumps(data).encode())
+
+        raw = HTTPResponse(
+            body=io.BytesIO(body), headers={'Content-Encoding': 'gzip'}, status=200, preload_content=False
+        )
+        request = requests.Request('GET', 'https://centra.example.com/api/v3.0/assets').prepare()
+        response = HTTPAdapter().build_response(request, raw)
+
+        centra = CentraAPI(management_url="centra.example.com")
+        self.assertEqual(centra._json(response), data)
+
+
+class LabelSession(object):
+    '''Serves a label listing with an ETag, answering 304 when the
+    request carries the current ETag'''
+
+    def __init__(self):
+        self.etag = '"1"'
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append((url, headers))
+
+        if headers.get('If-None-Match') == self.etag:
+            return FakeResponse(None, status_code=304)
+
+        return FakeResponse({'objects': [{'key': 'k', 'value': 'v'}], 'total_count': 1}, headers={'ETag': self.etag})
+
+
+class TestLabelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.centra = CentraAPI(management_url="centra.example.com")
+        self.centra.session = LabelSession()
+
+    def test_revalidates_with_etag(self):
+        first = self.centra.list_labels(key='k', value='v')
+        second = self.centra.list_labels(key='k', value='v')
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.centra.session.requests[0][1], {})
+        self.assertEqual(self.centra.session.requests[1][1], {'If-None-Match': '"1"'})
+
+    def test_snapshot_pages_revalidate(self):
+        self.centra.list_all_labels(key='k')
+        self.assertEqual(self.centra.list_all_labels(key='k'), [{'key': 'k', 'value': 'v'}])
+        self.assertEqual(self.centra.session.requests[1][1], {'If-None-Match': '"1"'})
+
+    def test_invalidation(self):
+        self.centra.list_labels(key='k', value='v')
+        self.centra.list_labels(key='other', value='v')
+        self.centra.list_all_labels(key='k')
+        self.centra.list_all_labels()
+
+        self.centra._invalidate_label_cache('k', 'v')
+
+        remaining = {cache_key[:2] for cache_key in self.centra._label_cache}
+        self.assertEqual(remaining, {('other', 'v')})
+
+
+if __name__ == '__main__':
+    unittest.main()
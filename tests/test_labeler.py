@@ -0,0 +1,171 @@
+import os
+import unittest
+import importlib.util
+
+import requests
+
+
+# The labeler is a script with a hyphenated name so load it by path
+spec = importlib.util.spec_from_file_location(
+    'labeler', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'gc-ad-labeler.py')
+)
+labeler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(labeler)
+
+
+class FakeCentra(object):
+    '''Answers list_agents from a list of agents, matching gc_filter
+    values by substring like Centra does, and records label writes'''
+
+    def __init__(self, agents=None, multi_value=True, fail=None):
+        self.agents = agents or []
+        self.multi_value = multi_value
+        self.fail = fail
+        self.filters = []
+        self.writes = []
+
+    def list_agents(self, gc_filter, limit=20):
+        self.filters.append(gc_filter)
+
+        if self.fail == 'none':
+            return None
+        if self.fail == 'raise':
+            raise requests.ConnectionError('connection refused')
+
+        if '|' in gc_filter and not self.multi_value:
+            return []
+
+        names = gc_filter.lower().split('|')
+        return [a for a in self.agents if any(n in a.get('name', '').lower() for n in names)]
+
+    def create_static_label(self, key, value, vms):
+        self.writes.append(('add', key, value, vms))
+        return not self.fail == 'write'
+
+    def remove_asset_from_label(self, key, value, vms):
+        self.writes.append(('remove', key, value, vms))
+        return not self.fail == 'write'
+
+
+AGENTS = [
+    {'name': 'pc1.contoso.com', 'asset_id': 'a1'},
+    {'name': 'PC10.contoso.com', 'asset_id': 'a10'},
+    {'name': 'pc2', 'asset_id': 'a2'},
+    {'asset_id': 'unnamed'}
+]
+
+
+class TestGetAgentIds(unittest.TestCase):
+
+    def setUp(self):
+        labeler._BATCH_LOOKUPS = True
+
+    def test_matches_short_names(self):
+        centra = FakeCentra(AGENTS)
+        self.assertEqual(labeler.get_agent_ids(centra, ['PC1', 'pc2', 'pc3']), ['a1', 'a2'])
+        self.assertEqual(centra.filters, ['PC1|pc2|pc3'])
+
+    def test_failed_lookup_raises(self):
+        with self.assertRaises(RuntimeError):
+            labeler.get_agent_ids(FakeCentra(fail='none'), ['pc1', 'pc2'])
+
+    def test_falls_back_without_multi_value_filter(self):
+        centra = FakeCentra(AGENTS, multi_value=False)
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(labeler.get_agent_ids(centra, ['pc1', 'pc2']), ['a1', 'a2'])
+        self.assertFalse(labeler._BATCH_LOOKUPS)
+
+        # Later batches go straight to individual lookups
+        centra.filters = []
+        labeler.get_agent_ids(centra, ['pc1', 'pc2'])
+        self.assertEqual(sorted(centra.filters), ['pc1', 'pc2'])
+
+    def test_batch_without_agents_keeps_batching(self):
+        labeler.get_agent_ids(FakeCentra(AGENTS), ['pc3', 'pc4'])
+        self.assertTrue(labeler._BATCH_LOOKUPS)
+
+
+class TestProcessRule(unittest.TestCase):
+
+    RULE = {'domains': {'contoso.com': {'target_dn': 'OU=Admins,DC=contoso,DC=com'}}, 'labels': {'k': 'v'}}
+    DOMAINS = {'contoso.com': {}}
+
+    def setUp(self):
+        labeler._BATCH_LOOKUPS = True
+        self.sync_computers = labeler.sync_computers
+        labeler.sync_computers = lambda *args: iter(['pc1', 'pc2'])
+
+    def tearDown(self):
+        labeler.sync_computers = self.sync_computers
+
+    def process(self, centra, added):
+        labels = {('k', 'v'): {'key': 'k', 'value': 'v', 'added_assets': [{'id': i} for i in added]}}
+        return labeler.process_rule('rule', self.RULE, self.DOMAINS, labels, centra)
+
+    def test_diff(self):
+        writes = self.process(FakeCentra(AGENTS), ['a1', 'old'])
+        self.assertEqual(writes, [('remove', 'k', 'v', ['old']), ('add', 'k', 'v', ['a2'])])
+
+    def test_new_label(self):
+        writes = labeler.process_rule('rule', self.RULE, self.DOMAINS, {}, FakeCentra(AGENTS))
+        self.assertEqual(writes, [('add', 'k', 'v', ['a1', 'a2'])])
+
+    def test_failed_lookup_skips_rule(self):
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.process(FakeCentra(fail='none'), ['a1', 'a2']), [])
+
+    def test_connection_error_skips_rule(self):
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.process(FakeCentra(fail='raise'), ['a1', 'a2']), [])
+
+    def test_no_agents_found_keeps_label(self):
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(self.process(FakeCentra([]), ['a1', 'a2']), [])
+
+    def test_empty_target_removes(self):
+        labeler.sync_computers = lambda *args: iter([])
+        self.assertEqual(self.process(FakeCentra(AGENTS), ['a1']), [('remove', 'k', 'v', ['a1'])])
+
+
+class TestApplyLabelChanges(unittest.TestCase):
+
+    def test_chunks_large_writes(self):
+        centra = FakeCentra()
+        vms = [str(i) for i in range(2500)]
+
+        labeler.apply_label_changes(centra, [('add', 'k', 'v', vms), ('remove', 'k', 'v', ['x'])])
+
+        adds = [w[3] for w in centra.writes if w[0] == 'add']
+        self.assertEqual([len(a) for a in adds], [1000, 1000, 500])
+        self.assertEqual([v for a in adds for v in a], vms)
+        self.assertIn(('remove', 'k', 'v', ['x']), centra.writes)
+
+    def test_reports_failures(self):
+        with self.assertLogs(level='ERROR') as logs:
+            labeler.apply_label_changes(FakeCentra(fail='write'), [('add', 'k', 'v', ['a1'])])
+        self.assertIn('Failed to add 1 assets for label k: v', logs.output[0])
+
+    def test_request_errors_are_failures(self):
+        centra = FakeCentra()
+
+        def refuse(*args):
+            raise requests.ConnectionError('connection refused')
+        centra.create_static_label = refuse
+
+        with self.assertLogs(level='ERROR') as logs:
+            labeler.apply_label_changes(centra, [('add', 'k', 'v', ['a1'])])
+        self.assertTrue(any('Failed to add 1 assets' in line for line in logs.output))
+
+
+class TestDnComponents(unittest.TestCase):
+
+    def test_spacing_and_case(self):
+        self.assertEqual(
+            labeler._dn_components('OU=Admins, DC=contoso, DC=com'),
+            labeler._dn_components('ou=admins,dc=Contoso,dc=com')
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()